@@ -11,6 +11,12 @@ Common case to use:
 
 No new queues are expected.
 
+Queues are bounded shared memory rings: addQueue(qname) gives QSIZE_DEFAULT (1024) slots,
+every pickled object must fit into slotsize bytes (MSG_MAX = 4096 by default),
+put of larger object raises MessageTooLarge. Pass bigger qsize/slotsize for large objects.
+Call closeAllQueues when queues are not needed, shared memory of queue is
+freed only on close (or when creating process drops the queue object).
+
 You can organize non-linear processing of tasks: return to the queue, transfer to different queues depending on the conditions, etc.
 
 Sample processing graph:
@@ -21,8 +27,19 @@ Sample processing graph:
      |----------------------------------------------------
 """
 
+import os
+import sys
+import enum
+import time
+import pickle
+import struct
+import array
+import copy
+import contextlib
+import collections
 import multiprocessing as mp
 import queue as qq
+import platform
 
 class MicroWhirlException(Exception):
     pass
@@ -33,52 +50,143 @@ class QueueNotExists(MicroWhirlException):
 class QueueTimeout(MicroWhirlException):
     pass
 
-#constant to signal process for soft closing
-SOFTCLOSE = "softclose"
+class MessageTooLarge(MicroWhirlException):
+    pass
+
+class Sig(enum.IntEnum):
+    """ Signals to process, sent as one byte through signal pipe
+    """
+    SOFTCLOSE = 1 #soft closing
+
+SOFTCLOSE = Sig.SOFTCLOSE
+
+class _Marker:
+    """ Unique constant, keeps identity after pickle (unpickled as module attribute)
+    """
+    def __init__(self, name):
+        self.name = name
+    def __repr__(self):
+        return self.name
+    def __reduce__(self):
+        return self.name
+
+#returned by try_get when there is nothing to get
+MISSING = _Marker("MISSING")
+#put by producer after its last item, consumers count them to finish
+SENTINEL = _Marker("SENTINEL")
+
+#default number of slots for queue created with qsize=0
+QSIZE_DEFAULT = 1024
+#default slot size (bytes) for pickled object in queue
+MSG_MAX = 4096
+#signal pipe is read/written by fd, Connection API is used elsewhere (Windows)
+_POSIX = os.name == 'posix'
+#x86 cpus don't reorder stores and loads seen by ring, others (ARM) need lock
+_WEAK_ORDER = platform.machine().lower() not in ('x86_64', 'amd64', 'i386', 'i686', 'x86')
+_NOLOCK = contextlib.nullcontext()
+#bytes/bytearray payload from this size is put out of pickle stream (copy is saved),
+#smaller ones are cheaper to pickle in-band
+OOB_MIN = 1 << 16
 
 class WhirlProcess(mp.Process):
     """ Base class process
     It can create two queues (by default) to communicate with parent process
+    Signals from parent come through one-byte writes to signal pipe, not through qInput
+    (raw non-blocking fd on POSIX, messages of Connection elsewhere)
+    Queues and pipe are created in addWorker within context of MicroWhirl,
+    process is started with start method of that context
     """
     def __init__(self, needInput = True, needOutput = True):
         mp.Process.__init__(self)
         self.whirl = None #this field must be set in addWorker
         self.qInput = None
         self.qOutput = None
-        if needInput:
-            self.qInput = mp.Queue()
-        if needOutput:
-            self.qOutput = mp.Queue()
+        self._sigR = None #signal pipe from parent, read end
+        self._sigW = None #write end
+        self._ctx = None
+        self._needInput = needInput
+        self._needOutput = needOutput
+        self._pinnedCpu = None #cpu to pin process to, set in addWorker
+    def attach(self, whirl, ctx):
+        """ Bind process to queues and multiprocessing context, called by addWorker
+        """
+        self.whirl = whirl
+        self._ctx = ctx
+        self._sigR, self._sigW = ctx.Pipe(duplex=False)
+        if _POSIX:
+            os.set_blocking(self._sigR.fileno(), False)
+            os.set_blocking(self._sigW.fileno(), False)
+        if self._needInput:
+            self.qInput = ctx.Queue()
+        if self._needOutput:
+            self.qOutput = ctx.Queue()
+    @staticmethod
+    def _Popen(process_obj):
+        #start with Popen of process context instead of default one
+        if process_obj._ctx is None:
+            return mp.Process._Popen(process_obj)
+        return process_obj._ctx.Process._Popen(process_obj)
+    def sendSignal(self, signal):
+        """ Send signal to process (from parent)
+            signal is dropped if pipe is full, many signals are pending already
+        """
+        if not _POSIX: #fileno of PipeConnection is handle
+            self._sigW.send_bytes(bytes((signal,)))
+            return
+        try:
+            os.write(self._sigW.fileno(), bytes((signal,)))
+        except BlockingIOError:
+            pass
+    def getSignal(self):
+        """ Return pending signal or None
+        """
+        if not _POSIX:
+            if self._sigR.poll():
+                return Sig(self._sigR.recv_bytes()[0])
+            return None
+        try:
+            b = os.read(self._sigR.fileno(), 1)
+            if b:
+                return Sig(b[0])
+        except BlockingIOError:
+            pass
+        return None
     def processSignals(self): pass
     def run(self): pass
     def cleanup(self):
+        #drain data left for this process, size is taken once (qOutput keeps results)
+        if self.qInput != None:
+            try:
+                n = self.qInput.qsize()
+            except NotImplementedError: #no qsize on macOS
+                n = sys.maxsize
+            try:
+                for i in range(n):
+                    self.qInput.get_nowait()
+            except qq.Empty:
+                pass
         for q in [self.qInput, self.qOutput]:
             if q != None:
                 q.close()
-                try:
-                    while True: q.get_nowait()
-                except:
-                    pass
 
 
 class SimpleWorkerProcess(WhirlProcess):
     """ Simple context-free worker
+    worker_func(whirl) is called in loop until soft close signal,
+    or until worker_func returns SOFTCLOSE itself
     """
     def __init__(self, worker_func):
         WhirlProcess.__init__(self, True, False)
         self.worker = worker_func
         self._softclose = False
     def processSignals(self):
-        try:
-            signal = self.qInput.get(False, 0.001)
-        except qq.Empty:
-            return
-        if signal == SOFTCLOSE:
+        if self.getSignal() is SOFTCLOSE:
             self._softclose = True
     def run(self):
         while not self._softclose:
             self.processSignals()
-            self.worker(self.whirl)
+            if self.worker(self.whirl) is SOFTCLOSE:
+                self._softclose = True
 
 class SoftcloseProcess(WhirlProcess):
     """ Abstract worker with soft close ability
@@ -87,11 +195,7 @@ class SoftcloseProcess(WhirlProcess):
         WhirlProcess.__init__(self, needInput, needOutput)
         self._softclose = False
     def processSignals(self):
-        try:
-            signal = self.qInput.get(False, 0.001)
-        except qq.Empty:
-            return
-        if signal == SOFTCLOSE:
+        if self.getSignal() is SOFTCLOSE:
             self._softclose = True
     def run(self):
         """ Main 
@@ -105,16 +209,343 @@ class SoftcloseProcess(WhirlProcess):
     def cleanup(self):
         WhirlProcess.cleanup(self)
 
+class RingQueue:
+    """ Bounded MPMC queue of pickled objects in shared memory
+
+    Objects are pickled into fixed-size slots of one SharedMemory arena.
+    Every slot has a sequence number (D. Vyukov bounded MPMC scheme):
+    producer reserves slot by advancing tail, copies data and publishes slot
+    by writing sequence, consumer does the same on head.
+    Sequence is 2*pos for free slot and 2*pos+1 for published one,
+    so queue of capacity 1 is handled too.
+    Locks are held only to advance head/tail, no pipe and no feeder thread.
+    x86 keeps store order, elsewhere (ARM) sequence is written under lock
+    of the other side, so slot data is seen before sequence.
+    put/get are non-blocking and raise queue.Full/queue.Empty like mp.Queue,
+    try_put/try_get report the same without exceptions
+    Slots are preallocated send buffers: views on them are made once,
+    consumer returns slot to producers by releasing sequence after unpickle.
+    Pickle protocol 5 is used: out-of-band buffers (bytes/bytearray payload
+    of OOB_MIN bytes and more, numpy arrays) are copied to slot directly, after pickle data and
+    their headers (size << 1 | readonly), not inside pickle stream.
+    Subclasses change slot storage with _encode/_store/_load
+    """
+    def __init__(self, capacity=QSIZE_DEFAULT, slotsize=MSG_MAX, ctx=None):
+        #imported here: shared_memory pulls secrets/hashlib, not every process needs it
+        #(unpickled queue in child imports it by itself)
+        from multiprocessing import shared_memory
+        ctx = ctx or mp.get_context()
+        self._initRing(capacity, ctx)
+        self.slotsize = slotsize
+        self._shm = shared_memory.SharedMemory(create=True, size=capacity*slotsize)
+        #size of pickle data << 16 | number of out-of-band buffers
+        self._len = ctx.RawArray('Q', capacity)
+        self._owner = os.getpid() #only creator unlinks shared memory
+        self._slots = self._slotViews()
+    def _slotViews(self):
+        buf = self._shm.buf
+        return [buf[i*self.slotsize:(i+1)*self.slotsize] for i in range(self.capacity)]
+    def __getstate__(self):
+        #memoryviews are not pickable, process gets its own views
+        #closed queue has no views already
+        state = self.__dict__.copy()
+        state.pop('_slots', None)
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._slots = None if self._closed else self._slotViews()
+    def __del__(self):
+        #shared memory can't be closed while views exist
+        #queue dropped without close is closed here, creator unlinks shared memory
+        if getattr(self, '_owner', None) == os.getpid():
+            self.close()
+        else:
+            self._releaseSlots()
+    def _releaseSlots(self):
+        for v in self.__dict__.pop('_slots', None) or ():
+            v.release()
+    def _initRing(self, capacity, ctx):
+        self.capacity = capacity
+        self._seq = ctx.RawArray('Q', range(0, 2*capacity, 2))
+        self._head = ctx.RawValue('Q', 0)
+        self._tail = ctx.RawValue('Q', 0)
+        self._headLock = ctx.Lock()
+        self._tailLock = ctx.Lock()
+        self._closed = False
+    def _encode(self, obj):
+        #prepare obj before slot is reserved, reserved slot must be published
+        bufs = []
+        if type(obj) in (bytes, bytearray) and len(obj) >= OOB_MIN:
+            obj = pickle.PickleBuffer(obj) #whole payload out-of-band, no copy in pickle
+        data = pickle.dumps(obj, protocol=5, buffer_callback=bufs.append)
+        n = len(data)
+        if bufs:
+            bufs = [b.raw() for b in bufs]
+            n += sum(8 + b.nbytes for b in bufs)
+        if n > self.slotsize or len(bufs) > 0xffff:
+            raise MessageTooLarge("object size %d exceeds slot size %d" % (n, self.slotsize))
+        return data, bufs
+    def _store(self, i, enc):
+        data, bufs = enc
+        slot = self._slots[i]
+        n = len(data)
+        slot[:n] = data
+        self._len[i] = n << 16 | len(bufs)
+        if bufs:
+            struct.pack_into('<%dQ' % len(bufs), slot, n, *[b.nbytes << 1 | b.readonly for b in bufs])
+            off = n + 8*len(bufs)
+            for b in bufs:
+                slot[off:off+b.nbytes] = b
+                off += b.nbytes
+    def _load(self, i):
+        slot = self._slots[i]
+        n = self._len[i]
+        k = n & 0xffff
+        n >>= 16
+        if not k:
+            return pickle.loads(slot[:n])
+        #buffers are copied out, slot is reused after release
+        buffers = []
+        off = n + 8*k
+        for h in struct.unpack_from('<%dQ' % k, slot, n):
+            size = h >> 1
+            buffers.append((bytes if h & 1 else bytearray)(slot[off:off+size]))
+            off += size
+        return pickle.loads(slot[:n], buffers=buffers)
+    def try_put(self, obj):
+        """ Put obj, return False if queue is full
+        """
+        if self._closed:
+            raise ValueError("queue is closed")
+        data = self._encode(obj)
+        with self._tailLock:
+            pos = self._tail.value
+            i = pos % self.capacity
+            if self._seq[i] != 2*pos: #slot still not consumed
+                return False
+            self._tail.value = pos + 1
+        self._store(i, data)
+        self._setSeq(self._headLock, pos, pos + 1, 1) #publish
+        return True
+    def try_get(self, default=None, shard=None):
+        """ Get obj, return default if queue is empty
+            shard is ignored, queue is not sharded
+        """
+        if self._closed:
+            raise ValueError("queue is closed")
+        with self._headLock:
+            pos = self._head.value
+            i = pos % self.capacity
+            if self._seq[i] != 2*pos + 1: #slot still not published
+                return default
+            self._head.value = pos + 1
+        try:
+            return self._load(i)
+        finally:
+            self._setSeq(self._tailLock, pos, pos + 1, 2*self.capacity) #release slot for next round
+    def put(self, obj):
+        if not self.try_put(obj):
+            raise qq.Full
+    def broadcast(self, obj, shards=None):
+        #queue is its only shard 0
+        if not self.try_put(obj):
+            e = qq.Full()
+            e.shards = [0]
+            raise e
+    def get(self, shard=None):
+        obj = self.try_get(MISSING)
+        if obj is MISSING:
+            raise qq.Empty
+        return obj
+    def get_many(self, n, shard=None):
+        """ Get up to n objects, head lock is taken once for whole batch
+            if some object can't be unpickled, first error is raised after batch,
+            other objects of batch are in its attribute partial
+        """
+        if self._closed:
+            raise ValueError("queue is closed")
+        with self._headLock:
+            start = self._head.value
+            pos = start
+            while pos - start < n and self._seq[pos % self.capacity] == 2*pos + 1:
+                pos += 1
+            self._head.value = pos
+        end = pos
+        res = []
+        error = None
+        for pos in range(start, end):
+            #first load error is raised after all with good objects,
+            #they are dequeued already
+            try:
+                res.append(self._load(pos % self.capacity))
+            except Exception as e:
+                if error is None:
+                    error = e
+        self._setSeq(self._tailLock, start, end, 2*self.capacity) #every reserved slot is released
+        if error is not None:
+            error.partial = res
+            raise error
+        return res
+    def _setSeq(self, lock, start, end, add):
+        #seq of positions start..end-1 is set to 2*pos + add,
+        #lock of reading side orders slot data before seq on weakly ordered cpus
+        with lock if _WEAK_ORDER else _NOLOCK:
+            for pos in range(start, end):
+                self._seq[pos % self.capacity] = 2*pos + add
+    def qsize(self):
+        return max(0, self._tail.value - self._head.value)
+    def close(self):
+        if self._closed: return
+        self._closed = True
+        self._releaseSlots()
+        self._shm.close()
+        if os.getpid() == self._owner:
+            self._shm.unlink()
+
+class ArrayQueue(RingQueue):
+    """ Bounded MPMC queue of numbers without pickle
+
+    Values are stored in shared array of typecode (as in array module),
+    slot sequencing is the same as in RingQueue
+    """
+    def __init__(self, typecode, capacity=QSIZE_DEFAULT, ctx=None):
+        array.array(typecode) #ValueError for typecode unknown to array ('c'), not on every put
+        ctx = ctx or mp.get_context()
+        self._initRing(capacity, ctx)
+        self.typecode = typecode
+        self._data = ctx.RawArray(typecode, capacity)
+    def _encode(self, v):
+        #ctypes arrays wrap out of range ints silently, array raises
+        #TypeError/OverflowError before slot is reserved
+        return array.array(self.typecode, (v,))[0]
+    def _store(self, i, v):
+        self._data[i] = v
+    def _load(self, i):
+        return self._data[i]
+    def __getstate__(self):
+        return self.__dict__
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+    def close(self):
+        self._closed = True
+
+class ShardedQueue:
+    """ Queue split to several RingQueue shards, one per consumer
+
+    put spreads objects round-robin over shards, counter is local to process,
+    so producers don't share memory for it; next shard is tried if one is full.
+    get takes from given shard only, or from any shard if shard is None,
+    shard out of range raises QueueNotExists
+    """
+    def __init__(self, nshards, capacity=QSIZE_DEFAULT, slotsize=MSG_MAX, ctx=None):
+        self.shards = [RingQueue(capacity, slotsize, ctx) for i in range(nshards)]
+        self._next = 0
+    def _shard(self, shard):
+        if not 0 <= shard < len(self.shards):
+            raise QueueNotExists("Shard %d not exists, queue has %d shards" % (shard, len(self.shards)))
+        return self.shards[shard]
+    def try_put(self, obj):
+        n = len(self.shards)
+        for k in range(n):
+            i = (self._next + k) % n
+            if self.shards[i].try_put(obj):
+                self._next = i + 1
+                return True
+        return False
+    def try_get(self, default=None, shard=None):
+        if shard is not None:
+            return self._shard(shard).try_get(default)
+        for q in self.shards:
+            obj = q.try_get(MISSING)
+            if obj is not MISSING:
+                return obj
+        return default
+    def put(self, obj):
+        if not self.try_put(obj):
+            raise qq.Full
+    def broadcast(self, obj, shards=None):
+        #put obj in every shard (or given shards), e.g. SENTINEL for every consumer
+        #full shards are skipped and raised in Full.shards, to retry broadcast with them only
+        left = [i for i in (range(len(self.shards)) if shards is None else shards)
+                if not self._shard(i).try_put(obj)]
+        if left:
+            e = qq.Full()
+            e.shards = left
+            raise e
+    def get(self, shard=None):
+        obj = self.try_get(MISSING, shard)
+        if obj is MISSING:
+            raise qq.Empty
+        return obj
+    def get_many(self, n, shard=None):
+        if shard is not None:
+            return self._shard(shard).get_many(n)
+        res = []
+        for q in self.shards:
+            try:
+                res.extend(q.get_many(n - len(res)))
+            except Exception as e:
+                #objects got from previous shards are not lost
+                e.partial = res + getattr(e, 'partial', [])
+                raise
+            if len(res) >= n: break
+        return res
+    def qsize(self):
+        return sum(q.qsize() for q in self.shards)
+    def close(self):
+        for q in self.shards:
+            q.close()
+
 class MicroWhirlQueues:
     """ Pickable queue list to transfer to child processes
+
+    shard is default shard of sharded queues for get,
+    worker added with shard gets its own copy by forShard
+    Queues are also numbered in order of adding (queueIndex),
+    put_i/get_i take queue by number without name lookup
     """
-    def __init__(self, qtimeout=1):
+    def __init__(self, qtimeout=1, ctx=None):
         self.qList = {}
+        self._qArr = [] #queues by index, shared with forShard copies as qList
         self.qTimeout = qtimeout #timeout to put in/get from queues
-    def addQueue(self, qname, qsize=0):
+        self._ctx = ctx or mp.get_context()
+        self.shard = None
+    def forShard(self, shard):
+        #same queues (qList is shared) with another default shard
+        for q in self._qArr:
+            if isinstance(q, ShardedQueue):
+                q._shard(shard) #bad shard fails in addWorker, not in worker
+        view = copy.copy(self)
+        view.shard = shard
+        return view
+    def addQueue(self, qname, qsize=0, slotsize=MSG_MAX):
         #add Queue by name, skip if exists
+        #qsize=0 means QSIZE_DEFAULT slots, queue is always bounded
+        #slotsize is max size of pickled object
+        if qname in self.qList: return
+        self._add(qname, RingQueue(qsize or QSIZE_DEFAULT, slotsize, self._ctx))
+    def addArrayQueue(self, qname, typecode, qsize=0):
+        #add queue of numbers with array module typecode ('q', 'd', ...), skip if exists
+        #put/get store values in shared array directly, without pickle
         if qname in self.qList: return
-        self.qList[qname] = mp.Queue(qsize)
+        self._add(qname, ArrayQueue(typecode, qsize or QSIZE_DEFAULT, ctx=self._ctx))
+    def addShardedQueue(self, qname, nshards, qsize=0, slotsize=MSG_MAX):
+        #add queue of nshards shards with qsize slots of slotsize bytes each, skip if exists
+        if qname in self.qList: return
+        self._add(qname, ShardedQueue(nshards, qsize or QSIZE_DEFAULT, slotsize, self._ctx))
+    def _add(self, qname, q):
+        self.qList[qname] = q
+        self._qArr.append(q)
+    def queueIndex(self, qname):
+        #number of queue for put_i/get_i, it is not changed by adding queues
+        if qname not in self.qList:
+            raise QueueNotExists("Queue "+qname+" not exists")
+        return self._qArr.index(self.qList[qname])
+    def _queueAt(self, i):
+        #negative index would take another queue
+        if not 0 <= i < len(self._qArr):
+            raise QueueNotExists("Queue #%d not exists" % i)
+        return self._qArr[i]
     def closeQueue(self, qname):
         #close Queue by name, skip if not exists
         if qname not in self.qList: return
@@ -127,32 +558,87 @@ class MicroWhirlQueues:
         return self.qList[qname].qsize()
     def put(self, qname, obj):
         #non-blocking try to put obj in queue
-        if qname not in self.qList:
+        q = self.qList.get(qname)
+        if q is None:
             raise QueueNotExists("Queue "+qname+" not exists")
-        try:
-            self.qList[qname].put(obj, False, self.qTimeout)
-        except qq.Full:
+        if not q.try_put(obj):
             raise QueueTimeout("put: queue "+qname+" timeout")
-    def get(self, qname):
-        #non-blocking try to get obj in queue
+    def put_i(self, i, obj):
+        #put by queue index
+        if not self._queueAt(i).try_put(obj):
+            raise QueueTimeout("put: queue #%d timeout" % i)
+    def broadcast(self, qname, obj, shards=None):
+        #put obj in every shard of queue (once for not sharded queue) or in given shards
+        #QueueTimeout.shards are shards obj is not put in, broadcast is retried with them
         if qname not in self.qList:
             raise QueueNotExists("Queue "+qname+" not exists")
         try:
-            return self.qList[qname].get(False, self.qTimeout)
-        except qq.Empty:
+            self.qList[qname].broadcast(obj, shards)
+        except qq.Full as e:
+            err = QueueTimeout("broadcast: queue %s timeout, shards %s" % (qname, e.shards))
+            err.shards = e.shards
+            raise err
+    def get(self, qname, shard=None):
+        #non-blocking try to get obj in queue
+        q = self.qList.get(qname)
+        if q is None:
+            raise QueueNotExists("Queue "+qname+" not exists")
+        obj = q.try_get(MISSING, self.shard if shard is None else shard)
+        if obj is MISSING:
             raise QueueTimeout("get: queue "+qname+" timeout")
+        return obj
+    def get_i(self, i, shard=None):
+        #get by queue index
+        obj = self._queueAt(i).try_get(MISSING, self.shard if shard is None else shard)
+        if obj is MISSING:
+            raise QueueTimeout("get: queue #%d timeout" % i)
+        return obj
+    def get_many(self, qname, n, shard=None):
+        #non-blocking get up to n objs from queue, empty list if queue is empty
+        q = self.qList.get(qname)
+        if q is None:
+            raise QueueNotExists("Queue "+qname+" not exists")
+        return q.get_many(n, self.shard if shard is None else shard)
+    def try_put(self, qname, obj):
+        #non-blocking put without exceptions, False if queue is full or not exists
+        q = self.qList.get(qname)
+        if q is None: return False
+        return q.try_put(obj)
+    def try_get(self, qname, default=MISSING, shard=None):
+        #non-blocking get without exceptions, default if queue is empty or not exists
+        q = self.qList.get(qname)
+        if q is None: return default
+        return q.try_get(default, self.shard if shard is None else shard)
 
 class MicroWhirl:
     """ Controller for main process
     
+    start_method is multiprocessing start method for all workers and queues,
+    None selects 'fork' on Linux (cheap start, no re-import), default start method
+    of multiprocessing elsewhere ('fork' is unsafe on macOS)
+    pin_cpus=True pins every worker to one cpu (round-robin over allowed cpus),
+    as taskset does, where os.sched_setaffinity is available
     """
-    def __init__(self, qtimeout=1):
+    def __init__(self, qtimeout=1, start_method=None, pin_cpus=False):
+        if start_method is None and sys.platform.startswith('linux'):
+            start_method = 'fork'
+        self._ctx = mp.get_context(start_method)
         self.wList = [] #process obj, tag
-        self.queues = MicroWhirlQueues(qtimeout)
+        self.queues = MicroWhirlQueues(qtimeout, self._ctx)
         self.maxProcId = 0
+        self._cpus = None
+        if pin_cpus and hasattr(os, 'sched_setaffinity'):
+            self._cpus = sorted(os.sched_getaffinity(0))
+        #indexes for tag/id selection, filled in addWorker
+        self._byTag = collections.defaultdict(list)
+        self._byId = {}
     #MicroWhirlQueues reflect
-    def addQueue(self, qname, qsize=0):
-        self.queues.addQueue(qname, qsize)
+    def addQueue(self, qname, qsize=0, slotsize=MSG_MAX):
+        self.queues.addQueue(qname, qsize, slotsize)
+    def addArrayQueue(self, qname, typecode, qsize=0):
+        self.queues.addArrayQueue(qname, typecode, qsize)
+    def addShardedQueue(self, qname, nshards, qsize=0, slotsize=MSG_MAX):
+        self.queues.addShardedQueue(qname, nshards, qsize, slotsize)
     def closeQueue(self, qname):
         self.queues.closeQueue(qname)
     def closeAllQueues(self):
@@ -161,78 +647,138 @@ class MicroWhirl:
         return self.queues.queueSize(qname)
     def put(self, qname, obj):
         self.queues.put(qname, obj)
-    def get(self, qname):
-        return self.queues.get(qname)
-    def addWorker(self, worker_obj, tag=''):
+    def broadcast(self, qname, obj, shards=None):
+        self.queues.broadcast(qname, obj, shards)
+    def get(self, qname, shard=None):
+        return self.queues.get(qname, shard)
+    def queueIndex(self, qname):
+        return self.queues.queueIndex(qname)
+    def put_i(self, i, obj):
+        self.queues.put_i(i, obj)
+    def get_i(self, i, shard=None):
+        return self.queues.get_i(i, shard)
+    def get_many(self, qname, n, shard=None):
+        return self.queues.get_many(qname, n, shard)
+    def try_put(self, qname, obj):
+        return self.queues.try_put(qname, obj)
+    def try_get(self, qname, default=MISSING, shard=None):
+        return self.queues.try_get(qname, default, shard)
+    def addWorker(self, worker_obj, tag='', shard=None):
         """ Add process object (worker) to control
         
         Process must be added before start
+        shard is default shard of sharded queues for get in this worker
         """
-        worker_obj.whirl = self.queues
+        whirl = self.queues if shard is None else self.queues.forShard(shard)
+        worker_obj.attach(whirl, self._ctx)
+        if self._cpus:
+            worker_obj._pinnedCpu = self._cpus[self.maxProcId % len(self._cpus)]
         self.maxProcId += 1
         self.wList.append( (worker_obj, tag, self.maxProcId) )
+        self._byTag[tag].append(worker_obj)
+        self._byId[self.maxProcId] = worker_obj
         return self.maxProcId
+    def warmup(self):
+        """ Start multiprocessing helper processes before workers
+            for 'forkserver' the server is started with this module preloaded,
+            so every worker is forked from warm interpreter;
+            for 'fork' and 'spawn' there is no helper process, nothing is done
+        """
+        if self._ctx.get_start_method() == 'forkserver':
+            from multiprocessing import forkserver
+            self._ctx.set_forkserver_preload([__name__])
+            forkserver.ensure_running()
+    def _select(self, predicate):
+        return [p for p, t, idd in self.wList if predicate(p,t,idd)]
+    def _selectById(self, procId):
+        p = self._byId.get(procId)
+        return () if p is None else (p,)
+    def _startWorkers(self, procs):
+        for p in procs:
+            p.start()
+            if p._pinnedCpu is not None:
+                try:
+                    os.sched_setaffinity(p.pid, {p._pinnedCpu})
+                except OSError: #already finished, or cpu is offline/out of cpuset now
+                    p._pinnedCpu = None #worker runs unpinned, rest are started anyway
+    def _closeWorkers(self, procs):
+        for p in procs:
+            p.sendSignal(SOFTCLOSE)
+    def _checkAlive(self, procs):
+        return any(p.is_alive() for p in procs)
+    def _join(self, procs, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for p in procs:
+            if p.pid is not None:
+                p.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not self._checkAlive(procs)
     def startWorkersByPredicate(self, predicate):
         """ Start workers by predicate(process, tag, processId)
         """
-        for p, t, idd in self.wList:
-            if predicate(p,t,idd):
-                p.start()
+        self._startWorkers(self._select(predicate))
     def startWorkerById(self, procId):
         """ Start worker by processId
         """
-        self.startWorkersByPredicate(lambda p,t,idd: idd == procId)
+        self._startWorkers(self._selectById(procId))
     def startWorkersByTag(self, tag):
         """ Start workers by tag
         """
-        self.startWorkersByPredicate(lambda p,t,idd: t == tag)
+        self._startWorkers(self._byTag.get(tag, ()))
     def startAllWorkers(self):
         """ Start all workers
         """
-        self.startWorkersByPredicate(lambda p,t,idd: True)
+        self._startWorkers(self._byId.values())
     def closeWorkersByPredicate(self, predicate):
         """ Soft close workers by predicate(process, tag, processId)
         """
-        for p, t, idd in self.wList:
-            if predicate(p,t,idd):
-                try:
-                    if p.qInput != None:
-                        p.qInput.put(SOFTCLOSE, False, 0)
-                except qq.Full:
-                    pass
+        self._closeWorkers(self._select(predicate))
     def closeWorkerById(self, procId):
         """ Soft close worker by id
         """
-        self.closeWorkersByPredicate(lambda p,t,idd: idd == procId)
+        self._closeWorkers(self._selectById(procId))
     def closeWorkersByTag(self, tag):
         """ Soft close workers by tag
         """
-        self.closeWorkersByPredicate(lambda p,t,idd: t == tag)
+        self._closeWorkers(self._byTag.get(tag, ()))
     def closeAllWorkers(self):
         """ Soft close all workers
         """
-        self.closeWorkersByPredicate(lambda p,t,idd: True)
+        self._closeWorkers(self._byId.values())
     def checkAliveByPredicate(self, predicate):
         """ Check alive processes by predicate
             return False only if all selected processes are dead
         """
-        alive = False
-        for p, t, idd in self.wList:
-            if predicate(p,t,idd):
-                alive = alive or p.is_alive()
-        return alive
+        return self._checkAlive(self._select(predicate))
     def checkAliveById(self, procId):
         """ Check alive processes by procss Id
             return False only if all processes are dead
         """
-        return self.checkAliveByPredicate(lambda p,t,idd: idd == procId)
+        return self._checkAlive(self._selectById(procId))
     def checkAliveByTag(self, tag):
         """ Check alive processes by tag
             return False only if all processes are dead
         """
-        return self.checkAliveByPredicate(lambda p,t,idd: t == tag)
+        return self._checkAlive(self._byTag.get(tag, ()))
     def checkAllAlive(self):
         """ Check alive all processes
             return False only if all processes are dead
         """
-        return self.checkAliveByPredicate(lambda p,t,idd: True)
+        return self._checkAlive(self._byId.values())
+    def joinByPredicate(self, predicate, timeout=None):
+        """ Wait for started processes selected by predicate to finish
+            blocks in join instead of polling is_alive
+            return False only if some selected process is alive after timeout
+        """
+        return self._join(self._select(predicate), timeout)
+    def joinById(self, procId, timeout=None):
+        """ Wait for process by process Id
+        """
+        return self._join(self._selectById(procId), timeout)
+    def joinByTag(self, tag, timeout=None):
+        """ Wait for processes by tag
+        """
+        return self._join(self._byTag.get(tag, ()), timeout)
+    def joinAll(self, timeout=None):
+        """ Wait for all processes
+        """
+        return self._join(self._byId.values(), timeout)
@@ -1,8 +1,19 @@
 import unittest
 from microwhirl import *
+import os
 import time
+import array
+import pickle
 import random
 import multiprocessing as mp
+from multiprocessing import shared_memory
+
+def _fail_unpickle():
+    raise ValueError("can't unpickle")
+
+class BadPickle:
+    def __reduce__(self):
+        return (_fail_unpickle, ())
 
 def test_worker1(whirl):
     whirl.put("testq", "test_value")
@@ -13,7 +24,7 @@ class ProcGen(WhirlProcess):
             self.whirl.put("testq", "test_value")
 
 #classes for complex test
-#put numbers from rng to queue
+#put numbers from rng to queue, then SENTINEL
 class Gen(WhirlProcess):
     def __init__(self, rng):
         WhirlProcess.__init__(self)
@@ -22,37 +33,32 @@ class Gen(WhirlProcess):
         for i in self.rng:
             self.whirl.put("procq", i)
             time.sleep(random.random()) #pause imitation
+        self.whirl.broadcast("procq", SENTINEL)
 
 def complex_worker(whirl):
-    try:
-        v = whirl.get("procq")
-    except QueueTimeout:
+    v = whirl.try_get("procq")
+    if v is MISSING:
         return
+    if v is SENTINEL: #one producer is done, pass it to saver and stop
+        whirl.put("saveq", SENTINEL)
+        return SOFTCLOSE
     time.sleep(random.random()) #pause imitation
     whirl.put("saveq", v*v)
 
 class Saver(WhirlProcess):
-    def __init__(self):
+    def __init__(self, nproducers):
         WhirlProcess.__init__(self)
-        self.saveset = []
-        self.keepwork = True
-    def processSignals(self):
-        try:
-            signal = self.qInput.get(False, 0.001)
-        except qq.Empty:
-            return
-        if signal == SOFTCLOSE:
-            self.keepwork = False
+        self.saveset = array.array('q') # 8 bytes per number, not int objects
+        self.nproducers = nproducers
     def run(self):
-        while True:
-            try:
-                v = self.whirl.get("saveq")
+        done = 0
+        while done < self.nproducers: # stop after SENTINEL of every producer
+            vals = self.whirl.get_many("saveq", 256)
+            if vals:
                 time.sleep(random.random())
-                self.saveset.append(v)
-            except QueueTimeout:
-                if not self.keepwork: # queue is empty and getted signal to stop
-                    break
-            self.processSignals()
+            nums = [v for v in vals if v is not SENTINEL]
+            done += len(vals) - len(nums)
+            self.saveset.extend(nums) # batch append
         self.qOutput.put(self.saveset)
 
 class Gen2(SoftcloseProcess):
@@ -63,18 +69,29 @@ class Gen2(SoftcloseProcess):
         for i in self.rng:
             self.whirl.put("procq", i)
             time.sleep(random.random()) #pause imitation
+        self.whirl.put("procq", SENTINEL)
+
+class Drainer(WhirlProcess):
+    def run(self):
+        self.cleanup()
+
+def fill_queue(q, n):
+    #feeder thread is joined at process exit, all items are in pipe after join
+    for i in range(n):
+        q.put(i)
 
 class Saver2(SoftcloseProcess):
     def run(self):
         self.saveset = []
-        while not self._softclose:
+        while True:
             self.processSignals()
-            try:
-                v = self.whirl.get("saveq")
+            v = self.whirl.try_get("saveq")
+            if v is MISSING:
+                if self._softclose: # queue is empty and getted signal to stop
+                    break
+            elif v is not SENTINEL:
                 time.sleep(random.random())
                 self.saveset.append(v)
-            except QueueTimeout:
-                pass
         self.qOutput.put(self.saveset)
         self.cleanup()
 
@@ -109,13 +126,193 @@ class TestWhirl(unittest.TestCase):
             pass
         #w.closeQueue("q1")
         w.closeAllQueues()
+    def testQRing(self):
+        w = MicroWhirl()
+        w.addQueue("q1", 3)
+        for i in range(3):
+            w.put("q1", i)
+        self.assertEqual(w.queueSize("q1"), 3)
+        try:
+            w.put("q1", 3)
+            self.fail("i can't put in full queue")
+        except QueueTimeout:
+            pass
+        self.assertFalse(w.try_put("q1", 3))
+        self.assertFalse(w.try_put("q3", 3))
+        self.assertIs(w.try_get("q3"), MISSING)
+        self.assertEqual([w.get("q1") for i in range(3)], [0, 1, 2])
+        w.put("q1", "round2") #slots are reused
+        w.put("q1", "round3")
+        self.assertEqual(w.get_many("q1", 128), ["round2", "round3"])
+        self.assertEqual(w.get_many("q1", 128), [])
+        self.assertIs(w.try_get("q1"), MISSING)
+        self.assertEqual(w.try_get("q1", None), None)
+        w.put("q1", "round4")
+        self.assertEqual(w.get("q1"), "round4")
+        try:
+            w.put("q1", "x"*MSG_MAX)
+            self.fail("object larger than slot")
+        except MessageTooLarge:
+            pass
+        q = w.queues.qList["q1"]
+        w.closeAllQueues()
+        self.assertNotIn("_slots", q.__getstate__()) #closed queue has no slot views
+        q = RingQueue(2)
+        name = q._shm.name
+        del q #dropped queue is unlinked by creator
+        self.assertRaises(FileNotFoundError, shared_memory.SharedMemory, name)
+    def testQBuffers(self):
+        w = MicroWhirl()
+        w.addQueue("q1", 8, 4*OOB_MIN)
+        data = bytes(range(256)) * (OOB_MIN//256) #out-of-band
+        w.put("q1", data)
+        w.put("q1", bytearray(data))
+        w.put("q1", pickle.PickleBuffer(bytearray(b"oob")))
+        w.put("q1", (data, [b"nested"]))
+        v = w.get("q1")
+        self.assertEqual(type(v), bytes)
+        self.assertEqual(v, data)
+        v = w.get("q1")
+        self.assertEqual(type(v), bytearray)
+        self.assertEqual(v, data)
+        self.assertEqual(bytes(w.get("q1")), b"oob")
+        self.assertEqual(w.get("q1"), (data, [b"nested"]))
+        w.put("q1", b"small") #in-band
+        self.assertEqual(w.get("q1"), b"small")
+        try:
+            w.put("q1", bytes(4*OOB_MIN))
+            self.fail("object larger than slot")
+        except MessageTooLarge:
+            pass
+        w.closeAllQueues()
+    def testQArray(self):
+        w = MicroWhirl()
+        w.addArrayQueue("qa", 'q', 2)
+        w.addArrayQueue("qd", 'd')
+        w.put("qa", 1)
+        w.put("qa", -2**40)
+        self.assertFalse(w.try_put("qa", 3))
+        self.assertEqual(w.get_many("qa", 10), [1, -2**40])
+        self.assertIs(w.try_get("qa"), MISSING)
+        self.assertRaises(TypeError, w.put, "qa", "1")
+        self.assertRaises(OverflowError, w.put, "qa", 2**64)
+        w.addArrayQueue("qb", 'b')
+        self.assertRaises(OverflowError, w.put, "qb", 300)
+        self.assertRaises(ValueError, w.addArrayQueue, "qc", 'c')
+        self.assertRaises(QueueNotExists, w.put, "qc", b"x")
+        self.assertFalse(w.queueSize("qb"))
+        w.put("qa", 5) #failed put does not hold slot
+        self.assertEqual(w.get("qa"), 5)
+        w.put("qd", 0.5)
+        self.assertEqual(w.get("qd"), 0.5)
+        w.closeAllQueues()
+    def testQSharded(self):
+        w = MicroWhirl()
+        w.addShardedQueue("q1", 2, 2)
+        for i in range(4):
+            w.put("q1", i)
+        self.assertFalse(w.try_put("q1", 4))
+        self.assertEqual(w.queueSize("q1"), 4)
+        self.assertEqual(w.get_many("q1", 10, 1), [1, 3]) #round-robin
+        self.assertIs(w.try_get("q1", MISSING, 1), MISSING)
+        self.assertEqual(w.get_many("q1", 10), [0, 2])
+        w.broadcast("q1", SENTINEL)
+        self.assertIs(w.get("q1", 0), SENTINEL)
+        self.assertIs(w.get("q1", 1), SENTINEL)
+        w.put("q1", 5) #shard 0
+        w.put("q1", 6) #shard 1
+        w.put("q1", 7) #shard 0 is full
+        try:
+            w.broadcast("q1", SENTINEL)
+            self.fail("shard 0 is full")
+        except QueueTimeout as e:
+            self.assertEqual(e.shards, [0])
+        self.assertEqual(w.get_many("q1", 10, 0), [5, 7])
+        w.broadcast("q1", SENTINEL, [0]) #retry with not delivered shards only
+        self.assertEqual(w.get_many("q1", 10, 0), [SENTINEL])
+        self.assertEqual(w.get_many("q1", 10, 1), [6, SENTINEL])
+        self.assertRaises(QueueNotExists, w.get, "q1", 2)
+        self.assertRaises(QueueNotExists, w.try_get, "q1", None, -1)
+        self.assertRaises(QueueNotExists, w.addWorker, SoftcloseProcess(), shard=2)
+        w.addShardedQueue("q2", 2, 1, 2*OOB_MIN)
+        w.put("q2", bytes(OOB_MIN)) #out-of-band payload needs big slots
+        self.assertEqual(w.get("q2"), bytes(OOB_MIN))
+        w.closeAllQueues()
+    def testQIndex(self):
+        w = MicroWhirl()
+        w.addQueue("q1", 1)
+        w.addArrayQueue("q2", 'q')
+        i1 = w.queueIndex("q1")
+        i2 = w.queueIndex("q2")
+        w.addQueue("q3")
+        self.assertEqual((i1, i2, w.queueIndex("q3")), (0, 1, 2))
+        self.assertRaises(QueueNotExists, w.queueIndex, "q4")
+        w.put_i(i1, "test")
+        self.assertRaises(QueueTimeout, w.put_i, i1, "test2")
+        w.put_i(i2, 7)
+        self.assertEqual(w.get("q1"), "test")
+        self.assertEqual(w.get_i(i2), 7)
+        self.assertRaises(QueueTimeout, w.get_i, i1)
+        self.assertRaises(QueueNotExists, w.put_i, 3, "test")
+        self.assertRaises(QueueNotExists, w.put_i, -1, "test")
+        self.assertRaises(QueueNotExists, w.get_i, -1)
+        self.assertEqual(w.queueSize("q3"), 0)
+        w.closeAllQueues()
+    def testQBadUnpickle(self):
+        w = MicroWhirl()
+        w.addQueue("q1", 4)
+        for v in [1, BadPickle(), 2, 3]:
+            w.put("q1", v)
+        try:
+            w.get_many("q1", 10)
+            self.fail("bad object in batch")
+        except ValueError as e:
+            self.assertEqual(e.partial, [1, 2, 3]) #only bad object is lost
+        for i in range(4): # no slot is lost
+            self.assertTrue(w.try_put("q1", i))
+        self.assertEqual(w.get_many("q1", 10), [0, 1, 2, 3])
+        w.put("q1", BadPickle())
+        self.assertRaises(ValueError, w.get, "q1")
+        w.put("q1", 5)
+        self.assertEqual(w.get("q1"), 5)
+        w.addShardedQueue("q2", 2, 2)
+        for v in [1, 2, 3, BadPickle()]: #shard 0: 1, 3; shard 1: 2, bad
+            w.put("q2", v)
+        try:
+            w.get_many("q2", 10)
+            self.fail("bad object in sharded batch")
+        except ValueError as e:
+            self.assertEqual(e.partial, [1, 3, 2])
+        self.assertEqual(w.queueSize("q2"), 0)
+        w.closeAllQueues()
+    def testQSentinel(self):
+        w = MicroWhirl()
+        w.addQueue("q1")
+        w.put("q1", SENTINEL)
+        self.assertIs(w.get("q1"), SENTINEL) #identity survives pickle
+        w.closeAllQueues()
+    def testSignals(self):
+        import microwhirl
+        posix = microwhirl._POSIX
+        try:
+            for microwhirl._POSIX in {posix, False}: #Connection path as on Windows
+                p = SoftcloseProcess(False, False)
+                p.attach(None, mp.get_context())
+                self.assertIs(p.getSignal(), None)
+                p.sendSignal(SOFTCLOSE)
+                self.assertIs(p.getSignal(), SOFTCLOSE)
+                self.assertIs(p.getSignal(), None)
+                p._sigR.close()
+                p._sigW.close()
+        finally:
+            microwhirl._POSIX = posix
     def testPQ1(self):
         w = MicroWhirl(2) #timeout 2 sec
         w.addQueue("testq")
         w.addWorker(SimpleWorkerProcess(test_worker1), 'simple')
         w.closeAllWorkers()
         w.startAllWorkers()
-        while w.checkAliveByTag("simple"): pass # wait for done
+        self.assertTrue(w.joinByTag("simple", 10)) # wait for done
         try:
             v = w.get("testq")
         except QueueTimeout:
@@ -129,7 +326,7 @@ class TestWhirl(unittest.TestCase):
         w.addWorker(ProcGen(), 'simple')
         w.closeAllWorkers()
         w.startAllWorkers()
-        while w.checkAliveByTag("simple"): pass # wait for done
+        w.joinByTag("simple") # wait for done
         n = 0
         try:
             while True:
@@ -142,6 +339,58 @@ class TestWhirl(unittest.TestCase):
         w.closeAllQueues()
         self.assertEqual(n, 5)
         time.sleep(1)
+    def testPQById(self):
+        w = MicroWhirl(2)
+        w.addQueue("testq")
+        id1 = w.addWorker(ProcGen(), 'simple')
+        id2 = w.addWorker(ProcGen(), 'simple')
+        w.startWorkerById(id2)
+        self.assertTrue(w.joinById(id2, 10))
+        self.assertFalse(w.checkAliveById(id1))
+        self.assertEqual(len(w.get_many("testq", 10)), 5)
+        w.closeAllQueues()
+    @unittest.skipUnless(hasattr(os, 'sched_setaffinity'), "no cpu affinity")
+    def testPQPinCpus(self):
+        cpus = sorted(os.sched_getaffinity(0))
+        w = MicroWhirl(2, pin_cpus=True)
+        w.addQueue("saveq")
+        svr = [Saver2(), Saver2(), Saver2()]
+        for p in svr:
+            w.addWorker(p, 'save')
+        svr[0]._pinnedCpu = 1 << 20 #cpu is not available, EINVAL
+        w.startAllWorkers()
+        self.assertIs(svr[0]._pinnedCpu, None)
+        self.assertEqual(os.sched_getaffinity(svr[0].pid), set(cpus))
+        self.assertEqual(os.sched_getaffinity(svr[1].pid), {cpus[1 % len(cpus)]})
+        self.assertEqual(os.sched_getaffinity(svr[2].pid), {cpus[2 % len(cpus)]})
+        w.closeAllWorkers()
+        for p in svr:
+            p.qOutput.get(True)
+        self.assertTrue(w.joinAll(10))
+        w.closeAllQueues()
+    def testPQCleanup(self):
+        w = MicroWhirl(2)
+        d = Drainer()
+        w.addWorker(d)
+        p = w._ctx.Process(target=fill_queue, args=(d.qInput, 100))
+        p.start()
+        p.join() #closing qInput here would close its reader too
+        w.startAllWorkers()
+        self.assertTrue(w.joinAll(10))
+        self.assertEqual(d.exitcode, 0)
+        self.assertEqual(d.qInput.qsize(), 0) #drained by child
+    def testPQStartMethods(self):
+        for method in mp.get_all_start_methods():
+            w = MicroWhirl(2, method)
+            w.warmup()
+            w.addQueue("testq")
+            w.addWorker(ProcGen(), 'simple')
+            w.addWorker(SimpleWorkerProcess(test_worker1), 'simple')
+            w.closeAllWorkers()
+            w.startAllWorkers()
+            self.assertTrue(w.joinByTag("simple", 30), method) # wait for done
+            self.assertEqual(len(w.get_many("testq", 10)), 6, method)
+            w.closeAllQueues()
     def testPQComplex(self):
         w = MicroWhirl(2) #timeout 2 sec
         w.addQueue("procq")
@@ -150,22 +399,30 @@ class TestWhirl(unittest.TestCase):
         w.addWorker(Gen([4,5,6]), 'gen')
         w.addWorker(SimpleWorkerProcess(complex_worker), 'proc')
         w.addWorker(SimpleWorkerProcess(complex_worker), 'proc')
-        svr = Saver()
+        svr = Saver(2)
         w.addWorker(svr, 'save')
-        w.closeWorkersByTag('gen')
         w.startAllWorkers()
-        while w.checkAliveByTag("gen"): pass
-        while w.queueSize("procq")>0: pass
-        w.closeWorkersByTag("proc")
-        while w.checkAliveByTag("proc"): pass
-        while w.queueSize("saveq")>0: pass
-        w.closeWorkersByTag("save")
         v = svr.qOutput.get(True)
+        self.assertTrue(w.joinAll(10))
         for i in [1,2,3,4,5,6]:
             self.assertTrue((i*i) in v, "%d not in result %s" % (i*i,','.join(map(str,v))))
         w.closeAllWorkers()
         w.closeAllQueues()
         time.sleep(1)
+    def testPQSharded(self):
+        w = MicroWhirl(2) #timeout 2 sec
+        w.addShardedQueue("procq", 2)
+        w.addQueue("saveq")
+        w.addWorker(Gen([1,2,3,4,5,6]), 'gen') # SENTINEL goes to every shard
+        w.addWorker(SimpleWorkerProcess(complex_worker), 'proc', shard=0)
+        w.addWorker(SimpleWorkerProcess(complex_worker), 'proc', shard=1)
+        svr = Saver(2)
+        w.addWorker(svr, 'save')
+        w.startAllWorkers()
+        v = svr.qOutput.get(True)
+        self.assertTrue(w.joinAll(10))
+        self.assertEqual(sorted(v), [i*i for i in [1,2,3,4,5,6]])
+        w.closeAllQueues()
     def testPQComplex2(self):
         w = MicroWhirl(2) #timeout 2 sec
         w.addQueue("procq")
@@ -178,11 +435,7 @@ class TestWhirl(unittest.TestCase):
         w.addWorker(svr, 'save')
         w.closeWorkersByTag('gen')
         w.startAllWorkers()
-        while w.checkAliveByTag("gen"): pass
-        while w.queueSize("procq")>0: pass
-        w.closeWorkersByTag("proc")
-        while w.checkAliveByTag("proc"): pass
-        while w.queueSize("saveq")>0: pass
+        w.joinByTag("proc") # workers stop on SENTINEL of producers
         w.closeWorkersByTag("save")
         v = svr.qOutput.get(True)
         for i in [1,2,3,4,5,6]: